@@ -1,14 +1,27 @@
 import asyncio
-import json
+import codecs
+import hashlib
 import logging
 import os
-from collections import defaultdict
-from typing import Dict, Optional
+import string
+import time
+import uuid
+import weakref
+from collections import OrderedDict, defaultdict
+from contextlib import aclosing, asynccontextmanager
+from itertools import chain
+from typing import Annotated, AsyncIterator, Dict, List, Optional
+
+import aiofiles
+import httpx
+import orjson
+import redis.asyncio as redis
+import uvloop
 
 from fastapi import Depends, FastAPI, HTTPException, Query, Request, Security
-from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.security import APIKeyHeader, APIKeyQuery
-from pydantic import BaseModel, constr
+from pydantic import AfterValidator, BaseModel, StringConstraints, constr
 from prometheus_fastapi_instrumentator import Instrumentator
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
@@ -22,13 +35,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- Event Loop ---
+# Applies to loops created after import; under uvicorn also pass `--loop uvloop`.
+asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 # --- Application Configuration ---
 LLAMA_CLI_PATH = "/home/viper/llama.cpp/build/bin/llama-cli"
+LLAMA_SERVER_PATH = "/home/viper/llama.cpp/build/bin/llama-server"
+LLAMA_SERVER_HOST = "127.0.0.1"
+LLAMA_SERVER_PORT = int(os.getenv("LLAMA_SERVER_PORT", "8080")) # Must be unique per API instance
+LLAMA_SERVER_STARTUP_TIMEOUT = 300 # seconds, covers loading large models
+USE_LLAMA_SERVER = os.getenv("USE_LLAMA_SERVER", "1") == "1" # Set to 0 to spawn llama-cli per request
 MODEL_PATH = "/home/viper/llama.cpp/models/zephyr/zephyr.gguf"
-HISTORY_DIR = "chat_history"
+HISTORY_DIR = os.getenv("HISTORY_DIR", "chat_history")
 MAX_HISTORY_MESSAGES = 10
 MAX_INPUT_LENGTH = 2048
 MAX_TOTAL_CHATS = 100
+HISTORY_FLUSH_INTERVAL = 0.2 # seconds
+STREAM_CHUNK_SIZE = 64 * 1024
+SUBPROCESS_STREAM_LIMIT = 4 * 1024 * 1024
+STREAM_FLUSH_BYTES = 4 * 1024
+STREAM_FLUSH_INTERVAL = 0.01 # seconds
+MAX_GENERATION_SECONDS = 600 # Generations running longer than this are stopped
 
 os.makedirs(HISTORY_DIR, exist_ok=True)
 
@@ -37,7 +65,47 @@ SECRET_API_KEY = "ViperROX"  # ⚠️ IMPORTANT: Change this!
 API_KEY_HEADER = APIKeyHeader(name="X-API-Key", auto_error=False)
 API_KEY_QUERY = APIKeyQuery(name="api_key", auto_error=False)
 limiter = Limiter(key_func=get_remote_address)
-chat_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+REDIS_URL = os.getenv("REDIS_URL") # Shared store for the concurrent request limiter
+MAX_CONCURRENT_REQUESTS_PER_CLIENT = 2
+CONCURRENT_REQUEST_WINDOW = MAX_GENERATION_SECONDS # A token never expires while its generation is still running
+MAX_CHAT_LOCKS = MAX_TOTAL_CHATS * 2
+chat_locks: "OrderedDict[str, asyncio.Lock]" = OrderedDict()
+_chat_lock_users: Dict[str, int] = {} # Holders + waiters per lock; a lock in use is never evicted
+
+def _get_chat_lock(chat_id: str) -> asyncio.Lock:
+    lock = chat_locks.get(chat_id)
+    if lock is not None:
+        chat_locks.move_to_end(chat_id)
+        return lock
+    lock = chat_locks[chat_id] = asyncio.Lock()
+    if len(chat_locks) > MAX_CHAT_LOCKS:
+        for stale_id in list(chat_locks):
+            if len(chat_locks) <= MAX_CHAT_LOCKS: break
+            if stale_id != chat_id and stale_id not in _chat_lock_users: del chat_locks[stale_id]
+    return lock
+
+@asynccontextmanager
+async def chat_lock(chat_id: str):
+    """Holds the lock for a chat. Least recently used idle locks are evicted past MAX_CHAT_LOCKS."""
+    lock = _get_chat_lock(chat_id)
+    _chat_lock_users[chat_id] = _chat_lock_users.get(chat_id, 0) + 1
+    try:
+        async with lock: yield
+    finally:
+        users = _chat_lock_users[chat_id] - 1
+        if users: _chat_lock_users[chat_id] = users
+        else: del _chat_lock_users[chat_id]
+
+# --- In-Memory Chat Cache ---
+# Holds the parsed data of every chat that exists on disk (bounded by MAX_TOTAL_CHATS).
+# Writes are coalesced by a background flusher, so the request path never touches the disk.
+CHAT_CACHE: Dict[str, dict] = {}
+DIRTY_CHATS: set = set() # Cached chats whose latest data is not yet on disk
+PROMPT_PREFIX_CACHE: Dict[str, str] = {} # Serialized system prompt + history per cached chat
+_flusher_task: Optional[asyncio.Task] = None
+# Requests that may create a new chat hold a reservation until the chat exists or they end,
+# so concurrent new chats cannot all pass the MAX_TOTAL_CHATS check at once.
+_pending_new_chats: Dict[str, set] = {} # chat_id -> reservation tokens of in-flight requests
 
 async def get_api_key(
     api_key_header: str = Security(API_KEY_HEADER),
@@ -57,20 +125,45 @@ async def get_api_key(
 
 # --- Pydantic Models ---
 SafeStr = constr(strip_whitespace=True, min_length=1, max_length=MAX_INPUT_LENGTH)
-SafeChatID = constr(strip_whitespace=True, min_length=1, max_length=50, pattern=r'^[a-zA-Z0-9_-]+$')
+_CHAT_ID_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
+
+def _validate_chat_id(chat_id: str) -> str:
+    # Set lookup instead of a regex match on every request
+    if not chat_id or len(chat_id) > 50 or not _CHAT_ID_CHARS.issuperset(chat_id):
+        raise ValueError("chat_id must be 1-50 characters of letters, digits, '_' or '-'")
+    return chat_id
+
+SafeChatID = Annotated[str, StringConstraints(strip_whitespace=True), AfterValidator(_validate_chat_id)]
 
 class ChatRequest(BaseModel):
     message: SafeStr
     chat_id: SafeChatID = "default"
 
 # --- FastAPI App Initialization ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Starts llama-server, then the history flusher; tears them down in reverse order."""
+    try:
+        await start_llama_server()
+        start_history_flusher()
+        try:
+            yield
+        finally:
+            await stop_history_flusher()
+    finally:
+        # Also runs if startup failed, so no orphaned server keeps the port and the loaded model
+        await stop_llama_server()
+        await concurrency_limiter.close()
+
 app = FastAPI(
     title="Full-Featured LLM Backend",
     description="An advanced, streaming-capable API for local LLMs via llama-cli.",
     version="1.2.0",
+    lifespan=lifespan,
 )
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+app.state.chat_count = len([f for f in os.listdir(HISTORY_DIR) if f.endswith(".json")])
 Instrumentator().instrument(app).expose(app)
 
 # --- Middleware (unchanged) ---
@@ -80,93 +173,424 @@ async def add_creator_header(request: Request, call_next):
     response.headers["X-Creator"] = "Made With <3 By SAHABAJ"
     return response
 
+# --- llama-server Lifecycle ---
+llama_server_process: Optional[asyncio.subprocess.Process] = None
+llama_client: Optional[httpx.AsyncClient] = None
+
+async def start_llama_server():
+    """Launches llama-server once so the model is loaded a single time for the process lifetime."""
+    global llama_server_process, llama_client
+    if not USE_LLAMA_SERVER: return
+    command = [LLAMA_SERVER_PATH, "-m", MODEL_PATH, "--host", LLAMA_SERVER_HOST, "--port", str(LLAMA_SERVER_PORT)]
+    logger.info(f"Starting llama-server on {LLAMA_SERVER_HOST}:{LLAMA_SERVER_PORT}")
+    llama_server_process = await asyncio.create_subprocess_exec(*command) # Inherits our stdout/stderr for its logs
+    llama_client = httpx.AsyncClient(base_url=f"http://{LLAMA_SERVER_HOST}:{LLAMA_SERVER_PORT}", timeout=None)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LLAMA_SERVER_STARTUP_TIMEOUT
+    while loop.time() < deadline:
+        if llama_server_process.returncode is not None:
+            raise RuntimeError(f"llama-server exited during startup with code {llama_server_process.returncode}")
+        try:
+            if (await llama_client.get("/health")).status_code == 200:
+                logger.info("llama-server is ready.")
+                return
+        except httpx.TransportError:
+            pass # Not listening yet
+        await asyncio.sleep(0.5)
+    raise RuntimeError("Timed out waiting for llama-server to load the model.")
+
+async def stop_llama_server():
+    if llama_client is not None: await llama_client.aclose()
+    if llama_server_process is not None and llama_server_process.returncode is None:
+        logger.info("Stopping llama-server.")
+        await terminate_process(llama_server_process, timeout=10.0)
+
 # --- Helper Functions (unchanged) ---
+_HISTORY_PATH_TMPL = HISTORY_DIR + os.sep + "{}.json"
+
 def get_sanitized_history_path(chat_id: SafeChatID) -> str:
-    return os.path.join(HISTORY_DIR, f"{chat_id}.json")
+    return _HISTORY_PATH_TMPL.format(chat_id)
 
-def load_chat_data(chat_id: SafeChatID) -> dict:
+async def load_chat_data(chat_id: SafeChatID) -> dict:
+    cached = CHAT_CACHE.get(chat_id)
+    if cached is not None: return cached
     history_file = get_sanitized_history_path(chat_id)
-    if os.path.exists(history_file):
-        with open(history_file, "r") as f: return json.load(f)
+    if await asyncio.to_thread(os.path.exists, history_file):
+        async with aiofiles.open(history_file, "rb") as f: data = orjson.loads(await f.read())
+        return CHAT_CACHE.setdefault(chat_id, data)
     return {"system_prompt": None, "history": []}
 
 def save_chat_data(chat_id: SafeChatID, data: dict):
-    history_file = get_sanitized_history_path(chat_id)
-    with open(history_file, "w") as f: json.dump(data, f, indent=2)
+    """Updates the cache and marks the chat for the next background flush."""
+    CHAT_CACHE[chat_id] = data
+    DIRTY_CHATS.add(chat_id)
+    PROMPT_PREFIX_CACHE[chat_id] = build_prompt_prefix(data.get("system_prompt"), data.get("history", [])[-MAX_HISTORY_MESSAGES:])
+
+def has_chat_capacity(chat_id: SafeChatID) -> bool:
+    return chat_id in _pending_new_chats or app.state.chat_count + len(_pending_new_chats) < MAX_TOTAL_CHATS
+
+def reserve_new_chat(chat_id: SafeChatID, owner: AsyncIterator[bytes]) -> bool:
+    """Reserves a MAX_TOTAL_CHATS slot for a new chat until `owner` (the response stream) is released."""
+    if not has_chat_capacity(chat_id): return False
+    token = object()
+    _pending_new_chats.setdefault(chat_id, set()).add(token)
+    # Tied to the stream's lifetime so the slot is freed even if the body is never iterated
+    weakref.finalize(owner, _release_new_chat, chat_id, token)
+    return True
+
+def _release_new_chat(chat_id: SafeChatID, token: object):
+    pending = _pending_new_chats.get(chat_id)
+    if pending is None: return # Chat was created, or this reservation was already released
+    pending.discard(token)
+    if not pending: del _pending_new_chats[chat_id]
+
+def _write_file_atomic(path: str, payload: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path) # Readers see either the old or the new file, never a partial one
+
+async def _flush_chat(chat_id: SafeChatID):
+    async with chat_lock(chat_id):
+        data = CHAT_CACHE.get(chat_id)
+        if data is None: # Deleted before the write happened
+            DIRTY_CHATS.discard(chat_id)
+            return
+        history_file = get_sanitized_history_path(chat_id)
+        try:
+            await asyncio.to_thread(_write_file_atomic, history_file, orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            DIRTY_CHATS.discard(chat_id)
+        except OSError as e:
+            logger.error(f"Failed to write '{history_file}': {e}")
+
+async def flush_dirty_chats():
+    for chat_id in list(DIRTY_CHATS): await _flush_chat(chat_id)
+
+async def _history_flusher():
+    while True:
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+        await flush_dirty_chats()
+
+def start_history_flusher():
+    global _flusher_task
+    _flusher_task = asyncio.create_task(_history_flusher())
+
+async def stop_history_flusher():
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try: await _flusher_task
+        except asyncio.CancelledError: pass
+    await flush_dirty_chats()
+
+ASSISTANT_MARKER = "### Assistant:"
+_TURN_TMPL = "### Human: {user}\n### Assistant: {assistant}\n".format_map
+_PENDING_TURN_TMPL = "### Human: {}\n### Assistant:".format
+
+def build_prompt_prefix(system_prompt: Optional[str], history: List[dict]) -> str:
+    """Serializes the system prompt and prior turns; the new message is appended to this."""
+    return "".join(chain((f"{system_prompt}\n",) if system_prompt else (), map(_TURN_TMPL, history)))
+
+def get_prompt_prefix(chat_id: SafeChatID, chat_data: dict) -> str:
+    prefix = PROMPT_PREFIX_CACHE.get(chat_id)
+    if prefix is None:
+        prefix = build_prompt_prefix(chat_data.get("system_prompt"), chat_data.get("history", [])[-MAX_HISTORY_MESSAGES:])
+        if chat_id in CHAT_CACHE: PROMPT_PREFIX_CACHE[chat_id] = prefix
+    return prefix
+
+def build_prompt(prefix: str, message: str) -> str:
+    """Builds the full model prompt from a cached prefix and the new message."""
+    return prefix + _PENDING_TURN_TMPL(message)
+
+# --- LLM Admission Control ---
+# Caps the number of concurrent generations across all chats (LLAMA_MAX_CONCURRENT).
+_admit_cv = asyncio.Condition()
+_active_llm_processes = 0
+_llm_concurrency_cap = int(os.getenv("LLAMA_MAX_CONCURRENT", "2"))
+
+async def acquire_llm_slot():
+    global _active_llm_processes
+    async with _admit_cv:
+        await _admit_cv.wait_for(lambda: _active_llm_processes < _llm_concurrency_cap)
+        _active_llm_processes += 1
+
+async def release_llm_slot():
+    global _active_llm_processes
+    async with _admit_cv:
+        _active_llm_processes -= 1
+        # Wake everyone: a single notified waiter may be cancelled before it runs, losing the wakeup.
+        # wait_for() re-checks the cap, so only as many waiters as there are free slots get in.
+        _admit_cv.notify_all()
+
+async def terminate_process(process: asyncio.subprocess.Process, timeout: float = 2.0):
+    """Terminates a subprocess, escalating to kill if it does not exit within the timeout.
+
+    Shielded, so the process is still reaped when the calling task is being cancelled
+    (e.g. the client disconnected mid-stream).
+    """
+    await asyncio.shield(_terminate_process(process, timeout))
+
+async def _terminate_process(process: asyncio.subprocess.Process, timeout: float):
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), timeout)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+async def read_coalesced(stream: asyncio.StreamReader) -> bytes:
+    """Reads from the stream, batching small writes for up to STREAM_FLUSH_INTERVAL so they go out as one ASGI message."""
+    chunk = await stream.read(STREAM_CHUNK_SIZE)
+    if not chunk or len(chunk) >= STREAM_FLUSH_BYTES: return chunk
+    loop = asyncio.get_running_loop()
+    parts, size = [chunk], len(chunk)
+    deadline = loop.time() + STREAM_FLUSH_INTERVAL
+    while size < STREAM_FLUSH_BYTES:
+        remaining = deadline - loop.time()
+        if remaining <= 0: break
+        try:
+            more = await asyncio.wait_for(stream.read(STREAM_CHUNK_SIZE - size), remaining)
+        except asyncio.TimeoutError:
+            break
+        if not more: break
+        parts.append(more)
+        size += len(more)
+    return b''.join(parts)
+
+class LLMProcessError(Exception):
+    """Raised by a generation backend when the model fails to produce a response."""
+
+async def generate_with_server(prompt: str) -> AsyncIterator[bytes]:
+    """Streams a completion from the persistent llama-server over its SSE endpoint."""
+    payload = {"prompt": prompt, "n_predict": -1, "stream": True}
+    # SSE events carry one token each; they are fed into a StreamReader so read_coalesced()
+    # batches them exactly like llama-cli stdout.
+    reader = asyncio.StreamReader(limit=SUBPROCESS_STREAM_LIMIT)
+
+    async def pump():
+        try:
+            async with llama_client.stream("POST", "/completion", json=payload) as response:
+                if response.status_code != 200:
+                    raise LLMProcessError((await response.aread()).decode('utf-8', 'ignore').strip())
+                async for line in response.aiter_lines():
+                    if line.startswith("error: "): # Mid-stream failure, e.g. prompt exceeds the context size
+                        error = orjson.loads(line[7:])
+                        raise LLMProcessError(error.get("message", line[7:]) if isinstance(error, dict) else line[7:])
+                    if not line.startswith("data: "): continue
+                    event = orjson.loads(line[6:])
+                    content = event.get("content")
+                    if content: reader.feed_data(content.encode('utf-8'))
+                    if event.get("stop"): break
+            reader.feed_eof()
+        except LLMProcessError as e:
+            reader.set_exception(e)
+        except Exception as e: # Any failure must reach the reader, or the request waits forever
+            reader.set_exception(LLMProcessError(f"llama-server request failed: {e!r}"))
+
+    pump_task = asyncio.create_task(pump())
+    try:
+        while True:
+            chunk = await read_coalesced(reader)
+            if not chunk: break
+            yield chunk
+    finally:
+        pump_task.cancel() # Closes the HTTP stream, which stops generation on the server
+
+async def generate_with_cli(prompt: str) -> AsyncIterator[bytes]:
+    """Streams the output of a one-off llama-cli process."""
+    # The prompt goes through stdin: long histories would otherwise be copied into argv (and can exceed ARG_MAX)
+    command = [LLAMA_CLI_PATH, "-m", MODEL_PATH, "-f", "/dev/stdin", "-n", "-1"]
+    process = await asyncio.create_subprocess_exec(
+        *command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        limit=SUBPROCESS_STREAM_LIMIT,
+    )
+    # Drain stderr concurrently (llama-cli logs heavily while loading); a full stderr pipe would block the process
+    stderr_task = asyncio.create_task(process.stderr.read())
+    try:
+        try:
+            process.stdin.write(prompt.encode('utf-8'))
+            await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # Process exited early; its stderr is reported below
+        finally:
+            process.stdin.close()
+        if process.stdout:
+            while True:
+                chunk = await read_coalesced(process.stdout)
+                if not chunk: break
+                yield chunk
+        await process.wait()
+    finally:
+        if process.returncode is None:
+            stderr_task.cancel() # Stopped early; nobody reads the logs
+            await terminate_process(process)
+    stderr = await stderr_task
+    if process.returncode != 0:
+        raise LLMProcessError(stderr.decode('utf-8', 'ignore').strip())
+
+# --- Concurrent Request Limiting ---
+# Complements the slowapi frequency limit: caps how many chat streams a single client
+# (API key + IP) may hold open at once. Uses a Redis sorted set of in-flight request IDs
+# when REDIS_URL is set, so the limit holds across instances; otherwise counts in-process.
+# In both modes entries expire after the window, so a slot whose release never ran (e.g. the
+# client disconnected before the response body started) is eventually reclaimed.
+_CONCURRENCY_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+class ConcurrentRequestLimiter:
+    def __init__(self, redis_url: Optional[str], limit: int, window: int):
+        self.limit, self.window = limit, window
+        self._redis = redis.from_url(redis_url) if redis_url else None
+        self._acquire_script = self._redis.register_script(_CONCURRENCY_ACQUIRE_SCRIPT) if self._redis else None
+        self._local: Dict[str, Dict[str, float]] = defaultdict(dict) # key -> {token: acquired_at}
+
+    async def acquire(self, key: str) -> Optional[str]:
+        """Returns a request token, or None if the client is already at its limit."""
+        token, now = uuid.uuid4().hex, time.time()
+        if self._redis is None:
+            tokens = self._local[key]
+            for stale in [t for t, acquired_at in tokens.items() if acquired_at <= now - self.window]: del tokens[stale]
+            if len(tokens) >= self.limit: return None
+            tokens[token] = now
+            return token
+        try:
+            admitted = await self._acquire_script(keys=[key], args=[now, self.window, self.limit, token])
+        except redis.RedisError as e:
+            # Fail open: an unavailable Redis should not take the chat endpoint down with it
+            logger.warning(f"Concurrency limiter unavailable, admitting request without a limit: {e}")
+            return token
+        return token if admitted else None
+
+    async def release(self, key: str, token: str):
+        if self._redis is None:
+            tokens = self._local.get(key)
+            if tokens is None: return
+            tokens.pop(token, None)
+            if not tokens: del self._local[key]
+            return
+        try:
+            await self._redis.zrem(key, token)
+        except redis.RedisError as e:
+            logger.warning(f"Failed to release concurrency slot (it expires after {self.window}s): {e}")
 
-# --- Core Logic (unchanged) ---
-async def stream_llama_response(chat_request: ChatRequest):
-    lock = chat_locks[chat_request.chat_id]
-    async with lock: chat_data = load_chat_data(chat_request.chat_id)
+    async def close(self):
+        if self._redis is not None: await self._redis.aclose()
 
-    system_prompt, chat_history = chat_data.get("system_prompt"), chat_data.get("history", [])[-MAX_HISTORY_MESSAGES:]
-    prompt_parts = []
-    if system_prompt:
-        logger.info(f"Using system prompt for chat_id '{chat_request.chat_id}'")
-        prompt_parts.append(system_prompt)
+    @staticmethod
+    def client_key(request: Request, api_key: Optional[str]) -> str:
+        # The API key is hashed so it never appears in Redis key names
+        key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16] if api_key else "anonymous"
+        return f"concurrency:{key_hash}:{get_remote_address(request)}"
 
-    for turn in chat_history: prompt_parts.append(f"### Human: {turn['user']}\n### Assistant: {turn['assistant']}")
-    prompt_parts.append(f"### Human: {chat_request.message}\n### Assistant:")
-    full_prompt = "\n".join(prompt_parts)
+concurrency_limiter = ConcurrentRequestLimiter(REDIS_URL, MAX_CONCURRENT_REQUESTS_PER_CLIENT, CONCURRENT_REQUEST_WINDOW)
 
-    command = [LLAMA_CLI_PATH, "-m", MODEL_PATH, "--prompt", full_prompt, "-n", "-1"]
-    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    
-    full_response_bytes = b''
-    if process.stdout:
-        while not process.stdout.at_eof():
-            token = await process.stdout.read(1)
-            if not token: break
-            full_response_bytes += token
-            yield token
-    await process.wait()
+async def release_when_done(stream: AsyncIterator[bytes], key: str, token: str) -> AsyncIterator[bytes]:
+    """Passes the stream through and frees the client's concurrency slot once it ends."""
+    try:
+        async with aclosing(stream):
+            async for chunk in stream: yield chunk
+    finally:
+        await asyncio.shield(concurrency_limiter.release(key, token)) # Still runs if the client disconnected
 
-    if process.returncode != 0:
-        stderr = (await process.stderr.read()).decode('utf-8', 'ignore').strip()
-        error_message = f"\n\n[ERROR] Model execution failed. Details:\n{stderr}\n"
-        logger.error(f"LLM process failed for chat_id '{chat_request.chat_id}': {stderr}")
+# --- Core Logic (unchanged) ---
+async def stream_llama_response(request: Request, chat_request: ChatRequest):
+    # Read-only snapshot; the lock is only needed for the read-modify-write after generation
+    chat_data = await load_chat_data(chat_request.chat_id)
+
+    if chat_data.get("system_prompt"):
+        logger.info(f"Using system prompt for chat_id '{chat_request.chat_id}'")
+    full_prompt = build_prompt(get_prompt_prefix(chat_request.chat_id, chat_data), chat_request.message)
+
+    generate = generate_with_server if USE_LLAMA_SERVER else generate_with_cli
+    decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+    text_chunks: List[str] = []
+    await acquire_llm_slot()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + MAX_GENERATION_SECONDS
+    try:
+        async with aclosing(generate(full_prompt)) as stream:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(stream), deadline - loop.time())
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise LLMProcessError(f"Generation exceeded the {MAX_GENERATION_SECONDS}s limit and was stopped.")
+                text_chunks.append(decoder.decode(chunk))
+                yield chunk
+                if await request.is_disconnected():
+                    logger.warning(f"Client disconnected, stopping generation for chat_id '{chat_request.chat_id}'")
+                    return
+    except LLMProcessError as e:
+        error_message = f"\n\n[ERROR] Model execution failed. Details:\n{e}\n"
+        logger.error(f"LLM process failed for chat_id '{chat_request.chat_id}': {e}")
         yield error_message.encode('utf-8')
         return
+    finally:
+        await asyncio.shield(release_llm_slot()) # Runs to completion even if the client disconnected
+    text_chunks.append(decoder.decode(b'', final=True))
 
-    assistant_response = full_response_bytes.decode('utf-8', 'ignore').split("### Assistant:")[-1].strip()
+    text = ''.join(text_chunks)
+    idx = text.rfind(ASSISTANT_MARKER)
+    assistant_response = (text[idx + len(ASSISTANT_MARKER):] if idx >= 0 else text).strip()
     if not assistant_response:
         logger.warning(f"LLM generated an empty response for chat_id '{chat_request.chat_id}'. History will not be updated.")
         return
 
-    async with lock:
-        final_chat_data = load_chat_data(chat_request.chat_id)
+    async with chat_lock(chat_request.chat_id):
+        final_chat_data = await load_chat_data(chat_request.chat_id)
+        is_new_chat = chat_request.chat_id not in CHAT_CACHE
         final_chat_data["history"].append({"user": chat_request.message, "assistant": assistant_response})
         final_chat_data["history"] = final_chat_data["history"][-MAX_HISTORY_MESSAGES:]
         save_chat_data(chat_request.chat_id, final_chat_data)
+        if is_new_chat:
+            app.state.chat_count += 1
+            _pending_new_chats.pop(chat_request.chat_id, None) # Reservation is now a real chat
         logger.info(f"History updated for chat_id: '{chat_request.chat_id}'")
 
 
 # --- [REFACTORED] Central Chat Request Handler ---
-async def process_chat_request(request: Request, chat_request: ChatRequest, dry_run: bool):
+async def process_chat_request(request: Request, chat_request: ChatRequest, dry_run: bool, api_key: Optional[str]):
     """Unified logic for handling both GET and POST chat requests."""
     log_extra = "(Dry Run)" if dry_run else ""
     logger.info(f"Chat request for '{chat_request.chat_id}' from IP: {request.client.host} {log_extra}")
 
     history_path = get_sanitized_history_path(chat_request.chat_id)
-    is_new_chat = not os.path.exists(history_path)
+    is_new_chat = chat_request.chat_id not in CHAT_CACHE and not await asyncio.to_thread(os.path.exists, history_path)
 
     if is_new_chat:
         logger.info(f"Creating new chat history for chat_id: '{chat_request.chat_id}'")
-        if len(os.listdir(HISTORY_DIR)) >= MAX_TOTAL_CHATS:
+        if not has_chat_capacity(chat_request.chat_id):
             raise HTTPException(status_code=429, detail="The maximum number of chat sessions has been reached.")
     else:
         logger.info(f"Reusing existing chat history for chat_id: '{chat_request.chat_id}'")
 
     if dry_run:
-        chat_data = load_chat_data(chat_request.chat_id)
-        system_prompt, history = chat_data.get("system_prompt"), chat_data.get("history", [])[-MAX_HISTORY_MESSAGES:]
-        prompt_parts = []
-        if system_prompt: prompt_parts.append(system_prompt)
-        for turn in history: prompt_parts.append(f"### Human: {turn['user']}\n### Assistant: {turn['assistant']}")
-        prompt_parts.append(f"### Human: {chat_request.message}\n### Assistant:")
-        return PlainTextResponse("\n".join(prompt_parts))
-        
-    return StreamingResponse(stream_llama_response(chat_request), media_type="text/plain")
+        chat_data = await load_chat_data(chat_request.chat_id)
+        return PlainTextResponse(build_prompt(get_prompt_prefix(chat_request.chat_id, chat_data), chat_request.message))
+
+    limiter_key = ConcurrentRequestLimiter.client_key(request, api_key)
+    token = await concurrency_limiter.acquire(limiter_key)
+    if token is None:
+        raise HTTPException(status_code=429, detail="Too many concurrent chat requests for this client.")
+    llm_stream = stream_llama_response(request, chat_request)
+    # Re-checked here since acquiring the limiter token may have awaited
+    if is_new_chat and not reserve_new_chat(chat_request.chat_id, llm_stream):
+        await concurrency_limiter.release(limiter_key, token)
+        raise HTTPException(status_code=429, detail="The maximum number of chat sessions has been reached.")
+    stream = release_when_done(llm_stream, limiter_key, token)
+    return StreamingResponse(stream, media_type="text/plain")
 
 
 # --- API Endpoints ---
@@ -182,7 +606,7 @@ async def health_check():
 @limiter.limit("20/hour")
 async def chat_post(request: Request, chat_request: ChatRequest, dry_run: bool = False, api_key: str = Depends(get_api_key)):
     """Handles a chat request via POST with a JSON body."""
-    return await process_chat_request(request, chat_request, dry_run)
+    return await process_chat_request(request, chat_request, dry_run, api_key)
 
 @app.get("/chat", tags=["Core"])
 @limiter.limit("20/hour")
@@ -195,16 +619,17 @@ async def chat_get(
 ):
     """Handles a chat request via GET with query parameters."""
     chat_request = ChatRequest(message=message, chat_id=chat_id)
-    return await process_chat_request(request, chat_request, dry_run)
+    return await process_chat_request(request, chat_request, dry_run, api_key)
 
 # --- Management Endpoints (unchanged) ---
 @app.get("/chats", tags=["History Management"])
 async def list_chats(api_key: str = Depends(get_api_key)):
     logger.info("Chat list requested.")
     try:
-        files = [f for f in os.listdir(HISTORY_DIR) if f.endswith(".json")]
+        files = [f for f in await asyncio.to_thread(os.listdir, HISTORY_DIR) if f.endswith(".json")]
         chat_ids = [os.path.splitext(f)[0] for f in files]
-        return {"chat_ids": chat_ids}
+        chat_ids += [cid for cid in CHAT_CACHE if f"{cid}.json" not in files] # Not yet flushed
+        return ORJSONResponse({"chat_ids": chat_ids})
     except OSError as e:
         logger.error(f"Failed to list chats in '{HISTORY_DIR}': {e}")
         raise HTTPException(status_code=500, detail="Failed to retrieve chat list.")
@@ -212,24 +637,39 @@ async def list_chats(api_key: str = Depends(get_api_key)):
 @app.get("/history/{chat_id}", tags=["History Management"])
 async def get_history(chat_id: SafeChatID, api_key: str = Depends(get_api_key)):
     logger.info(f"History requested for chat_id: '{chat_id}'")
+    if chat_id in DIRTY_CHATS:
+        return ORJSONResponse(CHAT_CACHE[chat_id])
     history_file = get_sanitized_history_path(chat_id)
-    if not os.path.exists(history_file):
+    # Serve the file bytes as-is; no parse/re-serialize round trip. Reading here (rather than
+    # via FileResponse, which opens the file after the handler returns) lets a concurrent
+    # delete surface as a 404 instead of a 500.
+    try:
+        async with aiofiles.open(history_file, "rb") as f: content = await f.read()
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Chat history not found.")
-    return load_chat_data(chat_id)
+    return Response(content, media_type="application/json")
 
 @app.delete("/history/{chat_id}", tags=["History Management"])
 async def delete_history(chat_id: SafeChatID, api_key: str = Depends(get_api_key)):
     logger.info(f"Delete request for chat_id: '{chat_id}'")
-    lock = chat_locks[chat_id]
-    async with lock:
+    async with chat_lock(chat_id):
         history_file = get_sanitized_history_path(chat_id)
-        if not os.path.exists(history_file):
+        if not await asyncio.to_thread(os.path.exists, history_file):
+            DIRTY_CHATS.discard(chat_id)
+            PROMPT_PREFIX_CACHE.pop(chat_id, None)
+            if CHAT_CACHE.pop(chat_id, None) is not None:
+                # Created but not yet flushed to disk
+                app.state.chat_count -= 1
+                return {"detail": f"Chat history '{chat_id}' deleted."}
             raise HTTPException(status_code=404, detail="Chat history not found.")
         try:
-            os.remove(history_file)
+            CHAT_CACHE.pop(chat_id, None)
+            DIRTY_CHATS.discard(chat_id)
+            PROMPT_PREFIX_CACHE.pop(chat_id, None)
+            await asyncio.to_thread(os.remove, history_file)
+            app.state.chat_count -= 1
             logger.info(f"History deleted for chat_id: '{chat_id}'")
             return {"detail": f"Chat history '{chat_id}' deleted."}
         except OSError as e:
             logger.error(f"Failed to delete '{history_file}': {e}")
             raise HTTPException(status_code=500, detail="Failed to delete history file.")
-            